@@ -0,0 +1,148 @@
+import json
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import numpy as np
+import SimpleITK as sitk
+from scipy.ndimage import distance_transform_edt
+
+
+@dataclass(frozen=True, kw_only=True)
+class VolumeGeometry:
+    origin: tuple[float, float, float]
+    spacing: tuple[float, float, float]
+    direction: tuple[float, ...]
+    """Flattened 3x3 direction matrix"""
+    size: tuple[int, int, int]
+    """Size in voxels (x, y, z)"""
+
+    @classmethod
+    def from_image(cls, volume: sitk.Image) -> "VolumeGeometry":
+        return cls(
+            origin=tuple(volume.GetOrigin()),
+            spacing=tuple(volume.GetSpacing()),
+            direction=tuple(volume.GetDirection()),
+            size=tuple(volume.GetSize()),
+        )
+
+
+class TissueDistanceFields:
+    def __init__(self, fields: np.ndarray, tissue_names: tuple[str, ...], geometry: VolumeGeometry,
+                 max_distance: float, tissue_labels: tuple[int, ...] | None = None):
+        """
+        Euclidean distance (in physical units) from each voxel to the nearest voxel of each tissue,
+        clipped at `max_distance`.
+
+        :param fields: float16 array of shape (n_tissues, z, y, x), possibly memory-mapped
+        :param tissue_names: names of the tissues in the order of the first axis of `fields`
+        :param geometry: geometry of the volume the fields were computed for
+        :param max_distance: distances are clipped to this value. Also used for tissues that are absent.
+        :param tissue_labels: label values of the tissues, in the same order as `tissue_names`
+        """
+        if len(fields) != len(tissue_names):
+            raise ValueError(f"Got {len(fields)} fields but {len(tissue_names)} tissue names")
+        if tissue_labels is not None and len(tissue_labels) != len(tissue_names):
+            raise ValueError(f"Got {len(tissue_labels)} tissue labels but {len(tissue_names)} tissue names")
+        self.fields = fields
+        self.tissue_names = tuple(tissue_names)
+        self.geometry = geometry
+        self.max_distance = max_distance
+        self.tissue_labels = None if tissue_labels is None else tuple(tissue_labels)
+
+    @classmethod
+    def compute(cls, volume: sitk.Image, tissue2label: dict[str, int], max_distance: float = 50.0
+                ) -> "TissueDistanceFields":
+        """
+        :param volume: labelmap volume
+        :param tissue2label: mapping from tissue names to label values, e.g. {"bones": 1, "tendins": 2, "ulnar": 3}
+        :param max_distance: distances are clipped to this value
+        """
+        labels = sitk.GetArrayFromImage(volume)
+        # array axes are (z, y, x), the spacing is given as (x, y, z)
+        sampling = volume.GetSpacing()[::-1]
+        fields = np.full((len(tissue2label), *labels.shape), max_distance, dtype=np.float16)
+        for i, label in enumerate(tissue2label.values()):
+            is_background = labels != label
+            if np.all(is_background):
+                continue
+            fields[i] = np.minimum(distance_transform_edt(is_background, sampling=sampling), max_distance)
+        return cls(fields, tuple(tissue2label), VolumeGeometry.from_image(volume), max_distance,
+                   tissue_labels=tuple(tissue2label.values()))
+
+    def save(self, directory: str | Path, name: str):
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        np.save(directory / f"{name}.npy", self.fields)
+        metadata = {
+            "tissue_names": self.tissue_names,
+            "geometry": asdict(self.geometry),
+            "max_distance": self.max_distance,
+            "tissue_labels": self.tissue_labels,
+        }
+        (directory / f"{name}.json").write_text(json.dumps(metadata))
+
+    @classmethod
+    def load(cls, directory: str | Path, name: str, mmap: bool = True) -> "TissueDistanceFields":
+        """
+        :param mmap: if True, the fields are memory-mapped instead of read into memory
+        """
+        directory = Path(directory)
+        fields = np.load(directory / f"{name}.npy", mmap_mode="r" if mmap else None)
+        metadata = json.loads((directory / f"{name}.json").read_text())
+        geometry = VolumeGeometry(**{key: tuple(value) for key, value in metadata["geometry"].items()})
+        tissue_labels = metadata.get("tissue_labels")
+        return cls(fields, tuple(metadata["tissue_names"]), geometry, metadata["max_distance"],
+                   tissue_labels=None if tissue_labels is None else tuple(tissue_labels))
+
+    @staticmethod
+    def exists(directory: str | Path, name: str) -> bool:
+        directory = Path(directory)
+        return (directory / f"{name}.npy").exists() and (directory / f"{name}.json").exists()
+
+    def matches(self, volume: sitk.Image, tissue2label: dict[str, int], max_distance: float) -> bool:
+        """:return: whether the fields were computed with the given parameters, e.g. to validate a cache"""
+        return (
+            self.tissue_names == tuple(tissue2label)
+            and self.tissue_labels == tuple(tissue2label.values())
+            and self.max_distance == max_distance
+            and self.geometry == VolumeGeometry.from_image(volume)
+        )
+
+    def sample(self, voxel_indices: np.ndarray) -> np.ndarray:
+        """
+        :param voxel_indices: integer array of shape (N, 3) with voxel indices (x, y, z) inside the volume
+        :return: float32 array of shape (n_tissues, N) with the distances at the given voxels
+        """
+        x, y, z = voxel_indices.T
+        return self.fields[:, z, y, x].astype(np.float32)
+
+
+def compute_distance_fields(
+    name2volume: dict[str, sitk.Image],
+    tissue2label: dict[str, int],
+    directory: str | Path,
+    max_distance: float = 50.0,
+    mmap: bool = True,
+) -> dict[str, TissueDistanceFields]:
+    """
+    Preprocessing step computing the distance fields of all volumes and storing them in the directory.
+    Fields that already exist in the directory are not recomputed, unless they were computed for different
+    tissues, labels, `max_distance` or volume geometry. Then they are overwritten.
+
+    :return: mapping from volume names to the (by default memory-mapped) distance fields
+    """
+    name2fields = {}
+    for name, volume in name2volume.items():
+        if TissueDistanceFields.exists(directory, name):
+            fields = TissueDistanceFields.load(directory, name, mmap=mmap)
+            if fields.matches(volume, tissue2label, max_distance):
+                name2fields[name] = fields
+                continue
+            print(f"Stored distance fields of {name} were computed with different parameters, recomputing")
+            # release the memory map before overwriting the file
+            del fields
+        else:
+            print(f"Computing distance fields of {name}")
+        TissueDistanceFields.compute(volume, tissue2label, max_distance).save(directory, name)
+        name2fields[name] = TissueDistanceFields.load(directory, name, mmap=mmap)
+    return name2fields
@@ -1,5 +1,6 @@
+import copy
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Any, Generic, TypeVar
 
 import gymnasium as gym
@@ -80,6 +81,7 @@ class ModularEnv(gym.Env, Generic[TStateAction, TAction, TObs], ABC):
         self._cur_observation: TObs | None = None
         self._cur_reward: float | None = None
         self._cur_state_action: TStateAction | None = None
+        self._fork_parent_np_random: np.random.Generator | None = None
 
 
     @dataclass
@@ -106,6 +108,88 @@ class ModularEnv(gym.Env, Generic[TStateAction, TAction, TObs], ABC):
             info=self.get_info_dict(),
         )
 
+    @dataclass(frozen=True)
+    class Snapshot:
+        """
+        The small mutable part of the env's state. Volumes, caches and other heavy members are
+        not part of it and are shared by reference between an env and its forks.
+        """
+        episode_len: int
+        state_action: TStateAction | None
+        observation: TObs | None
+        reward: float | None
+        is_terminated: bool
+        is_truncated: bool
+        is_closed: bool
+        extra: dict[str, Any] = field(default_factory=dict)
+        """Subclass-specific state, see :meth:`ModularEnv._get_snapshot_extra`."""
+
+
+    def snapshot(self) -> Snapshot:
+        """
+        Captures the current state of the env such that it can be returned to later with :meth:`restore`.
+        State-actions and observations are stored by reference, they are treated as immutable by the env.
+        """
+        return self.Snapshot(
+            episode_len=self._cur_episode_len,
+            state_action=self._cur_state_action,
+            observation=self._cur_observation,
+            reward=self._cur_reward,
+            is_terminated=self._is_terminated,
+            is_truncated=self._is_truncated,
+            is_closed=self._is_closed,
+            extra=self._get_snapshot_extra(),
+        )
+
+    def restore(self, snapshot: Snapshot) -> None:
+        """
+        Sets the env to the state captured by :meth:`snapshot`. Nothing is recomputed.
+        """
+        self._restore_snapshot_extra(snapshot.extra)
+        self._cur_episode_len = snapshot.episode_len
+        self._cur_state_action = snapshot.state_action
+        self._cur_observation = snapshot.observation
+        self._cur_reward = snapshot.reward
+        self._is_terminated = snapshot.is_terminated
+        self._is_truncated = snapshot.is_truncated
+        self._is_closed = snapshot.is_closed
+
+    def fork(self: TEnv) -> TEnv:
+        """
+        Creates an independent copy of the env at its current state, e.g. for tree search or branching rollouts.
+        Stepping the fork does not affect the original env and vice versa. Reward metric, observation,
+        termination criterion and any other members (like volumes) are shared by reference, so forking is cheap.
+        The fork gets its own random generator, spawned from the one of the original env on first use.
+        """
+        forked = copy.copy(self)
+        forked.restore(self.snapshot())
+        if self._np_random is not None or self._fork_parent_np_random is not None:
+            # sharing the generator would make the fork consume the random stream of the original env.
+            # Spawning is deferred since most forks (e.g. in tree search) never draw random numbers.
+            forked._np_random = None
+            forked._fork_parent_np_random = self.np_random
+        return forked
+
+    @property
+    def np_random(self) -> np.random.Generator:
+        if self._np_random is None and self._fork_parent_np_random is not None:
+            self._np_random = self._fork_parent_np_random.spawn(1)[0]
+            self._fork_parent_np_random = None
+        return super().np_random
+
+    @np_random.setter
+    def np_random(self, value: np.random.Generator):
+        self._fork_parent_np_random = None
+        gym.Env.np_random.fset(self, value)
+
+    def _get_snapshot_extra(self) -> dict[str, Any]:
+        # override this if the subclass holds additional mutable state that should be part of a snapshot
+        return {}
+
+    def _restore_snapshot_extra(self, extra: dict[str, Any]) -> None:
+        # override this together with _get_snapshot_extra
+        pass
+
     @property
     def is_closed(self):
         return self._is_closed
@@ -0,0 +1,196 @@
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from image_navigation.envs.labelmaps_navigation import LabelmapEnv
+
+
+class InitialPoseIndex:
+    def __init__(self, name2poses: dict[str, np.ndarray], name2losses: dict[str, np.ndarray], num_bins: int):
+        """
+        Precomputed starting poses per volume together with the standard-plane loss at each pose. The poses of
+        each volume are binned by difficulty (rank of the loss within that volume), bin 0 holding the easiest ones.
+        The loss is discrete, so poses with equal loss are never split: they all go to the bin of their highest
+        rank. A higher loss therefore never ends up in an easier bin.
+        Use :meth:`build` to compute the index and :meth:`save`/:meth:`load` to reuse it.
+
+        :param name2poses: mapping from volume names to arrays of shape (N, action_dim)
+        :param name2losses: mapping from volume names to arrays of shape (N,)
+        :param num_bins: number of difficulty bins
+        """
+        if not name2poses:
+            raise ValueError("name2poses must not be empty")
+        if name2poses.keys() != name2losses.keys():
+            raise ValueError("name2poses and name2losses must have the same keys")
+        if num_bins < 1:
+            raise ValueError(f"num_bins must be positive, got {num_bins}")
+        self.name2poses = name2poses
+        self.name2losses = name2losses
+        self.num_bins = num_bins
+        self.volume_names = tuple(name2poses)
+
+        self._name2bin_indices: dict[str, list[np.ndarray]] = {}
+        self._name2bin_mask: dict[str, np.ndarray] = {}
+        for name, losses in name2losses.items():
+            if len(losses) != len(name2poses[name]) or len(losses) == 0:
+                raise ValueError(f"Volume '{name}' needs the same, positive number of poses and losses")
+            losses = np.asarray(losses)
+            highest_ranks = np.searchsorted(np.sort(losses), losses, side="right") - 1
+            bins = highest_ranks * num_bins // len(losses)
+            self._name2bin_indices[name] = [np.flatnonzero(bins == b) for b in range(num_bins)]
+            self._name2bin_mask[name] = np.array([len(idx) > 0 for idx in self._name2bin_indices[name]])
+
+    def non_empty_bins(self, volume_name: str) -> np.ndarray:
+        """:return: boolean array of shape (num_bins,). Bins can be empty if many poses have the same loss."""
+        return self._name2bin_mask[volume_name]
+
+    def sample(self, volume_name: str, bin_idx: int, rng: np.random.Generator) -> tuple[np.ndarray, float]:
+        """:return: a pose from the given bin and the loss at that pose"""
+        indices = self._name2bin_indices[volume_name][bin_idx]
+        if len(indices) == 0:
+            raise ValueError(f"Bin {bin_idx} of volume '{volume_name}' is empty")
+        i = indices[rng.integers(len(indices))]
+        return self.name2poses[volume_name][i], float(self.name2losses[volume_name][i])
+
+    @classmethod
+    def build(
+        cls,
+        env: "LabelmapEnv",
+        slice_loss_fn: Callable[[np.ndarray], float],
+        pose_low: np.ndarray,
+        pose_high: np.ndarray,
+        num_poses_per_volume: int = 256,
+        num_bins: int = 4,
+        rng: np.random.Generator | None = None,
+    ) -> "InitialPoseIndex":
+        """
+        Samples poses uniformly from the box [pose_low, pose_high] for each volume of the env and computes the
+        loss of the corresponding slices.
+
+        :param env: env providing the volumes and the slicing
+        :param slice_loss_fn: computes the standard-plane loss of a 2D labelmap slice,
+            e.g. `lambda s: loss_fct(tissues.cluster_iter(s))`
+        :param pose_low: lower bounds of the poses, same shape as an action
+        :param pose_high: upper bounds of the poses, same shape as an action
+        """
+        rng = rng or np.random.default_rng()
+        pose_low, pose_high = np.asarray(pose_low, dtype=float), np.asarray(pose_high, dtype=float)
+        name2poses, name2losses = {}, {}
+        for name in env.name2volume:
+            poses = rng.uniform(pose_low, pose_high, size=(num_poses_per_volume, *pose_low.shape))
+            name2poses[name] = poses
+            name2losses[name] = np.array([slice_loss_fn(env.get_slice(name, pose)) for pose in poses])
+        return cls(name2poses, name2losses, num_bins)
+
+    def save(self, path: str | Path):
+        arrays = {}
+        for i, name in enumerate(self.volume_names):
+            arrays[f"poses_{i}"] = self.name2poses[name]
+            arrays[f"losses_{i}"] = self.name2losses[name]
+        np.savez(path, volume_names=np.array(self.volume_names), num_bins=self.num_bins, **arrays)
+
+    @classmethod
+    def load(cls, path: str | Path) -> "InitialPoseIndex":
+        with np.load(path) as data:
+            volume_names = [str(name) for name in data["volume_names"]]
+            name2poses = {name: data[f"poses_{i}"] for i, name in enumerate(volume_names)}
+            name2losses = {name: data[f"losses_{i}"] for i, name in enumerate(volume_names)}
+            num_bins = int(data["num_bins"])
+        return cls(name2poses, name2losses, num_bins)
+
+
+class CurriculumSampler:
+    def __init__(
+        self,
+        index: InitialPoseIndex,
+        bin_weights: np.ndarray | None = None,
+        success_threshold: float = 0.7,
+        ema_decay: float = 0.95,
+        min_episodes_per_bin: int = 20,
+        rng: np.random.Generator | None = None,
+    ):
+        """
+        Samples initial volumes and poses from an :class:`InitialPoseIndex` in O(1).
+
+        By default, the curriculum starts with the easiest bin only. The bins up to the current frontier bin are
+        sampled uniformly and the frontier advances to the next harder bin once the success rate of episodes
+        starting in it exceeds `success_threshold`. Outcomes are reported through :meth:`update`, the index is
+        never rebuilt.
+
+        :param index: the precomputed starting poses
+        :param bin_weights: if given, fixed (unnormalized) sampling weights of the bins, which disables
+            the progression of the frontier
+        :param success_threshold: success rate at which the frontier advances
+        :param ema_decay: decay of the exponential moving averages of the success rates
+        :param min_episodes_per_bin: minimal number of outcomes reported for the frontier bin before it can advance
+        :param rng: if None, a new default generator is used
+        """
+        if bin_weights is not None:
+            bin_weights = np.asarray(bin_weights, dtype=float)
+            if bin_weights.shape != (index.num_bins,) or np.any(bin_weights < 0) or bin_weights.sum() <= 0:
+                raise ValueError(f"bin_weights must be {index.num_bins} non-negative weights with a positive sum")
+        self.index = index
+        self.success_threshold = success_threshold
+        self.ema_decay = ema_decay
+        self.min_episodes_per_bin = min_episodes_per_bin
+        self.rng = rng or np.random.default_rng()
+
+        self._fixed_bin_weights = bin_weights
+        self._success_rates = np.zeros(index.num_bins)
+        self._num_episodes = np.zeros(index.num_bins, dtype=int)
+        self._is_bin_used = np.any([index.non_empty_bins(name) for name in index.volume_names], axis=0)
+        self._frontier = 0
+        self._skip_unused_bins()
+
+    @property
+    def frontier(self) -> int:
+        return self._frontier
+
+    @property
+    def success_rates(self) -> np.ndarray:
+        return self._success_rates.copy()
+
+    @property
+    def bin_weights(self) -> np.ndarray:
+        """Current unnormalized sampling weights of the bins."""
+        if self._fixed_bin_weights is not None:
+            return self._fixed_bin_weights
+        return (np.arange(self.index.num_bins) <= self._frontier).astype(float)
+
+    def sample(self) -> tuple[str, np.ndarray, int]:
+        """:return: volume name, initial pose and its difficulty bin"""
+        volume_names = self.index.volume_names
+        volume_name = volume_names[self.rng.integers(len(volume_names))]
+        weights = self.bin_weights * self.index.non_empty_bins(volume_name)
+        if weights.sum() == 0:
+            # all allowed bins are empty for this volume, fall back to its easiest non-empty bin
+            bin_idx = int(np.argmax(self.index.non_empty_bins(volume_name)))
+        else:
+            bin_idx = int(self.rng.choice(len(weights), p=weights / weights.sum()))
+        pose, _ = self.index.sample(volume_name, bin_idx, self.rng)
+        return volume_name, pose, bin_idx
+
+    def update(self, bin_idx: int, is_success: bool):
+        """Reports the outcome of an episode that started from a pose of the given bin."""
+        if self._num_episodes[bin_idx] == 0:
+            self._success_rates[bin_idx] = float(is_success)
+        else:
+            self._success_rates[bin_idx] = (
+                self.ema_decay * self._success_rates[bin_idx] + (1 - self.ema_decay) * float(is_success)
+            )
+        self._num_episodes[bin_idx] += 1
+        if (
+            self._fixed_bin_weights is None
+            and bin_idx == self._frontier < self.index.num_bins - 1
+            and self._num_episodes[bin_idx] >= self.min_episodes_per_bin
+            and self._success_rates[bin_idx] >= self.success_threshold
+        ):
+            self._frontier += 1
+            self._skip_unused_bins()
+
+    def _skip_unused_bins(self):
+        # bins that are empty for all volumes would never receive outcomes, so the frontier could not advance
+        while self._frontier < self.index.num_bins - 1 and not self._is_bin_used[self._frontier]:
+            self._frontier += 1
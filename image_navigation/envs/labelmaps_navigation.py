@@ -1,15 +1,17 @@
 from abc import ABC
 from dataclasses import dataclass
+from typing import Any
 
 import SimpleITK as sitk
 import gymnasium as gym
 import numpy as np
 
-from image_navigation.envs.base import ArrayObservation, ModularEnv, RewardMetric, StateAction, \
-    TStateAction, \
-    TerminationCriterion
+from image_navigation.envs.base import ArrayObservation, EnvPreconditionError, ModularEnv, RewardMetric, \
+    StateAction, TStateAction, TerminationCriterion
+from image_navigation.envs.curriculum import CurriculumSampler
 from image_navigation.slicing import slice_volume
-from image_navigation.util.img_processing import crop_center
+from image_navigation.sparse_slicing import BBox, BrickOccupancyIndex
+from image_navigation.util.img_processing import crop_center, pack_label_channels
 
 
 @dataclass(kw_only=True)
@@ -19,6 +21,11 @@ class LabelmapStateAction(StateAction):
     labels_2d_slice: np.ndarray
     """Two-dimensional slice of the labelmap, i.e., an array of shape (N, M) with integer values.
     Each integer represents a different label (bone, nerve, etc.)"""
+    labelmap_name: str | None = None
+    """Name of the labelmap the slice was taken from."""
+    label2bbox: dict[int, BBox | None] | None = None
+    """Bounding boxes of the labels in the slice, only available with sparse slicing.
+    Can be passed to :meth:`image_navigation.tissue_clustering.Tissues.cluster_iter`."""
     optimal_position: np.ndarray | None = None
     """The optimal position for the 2D slice, i.e., the position where the slice is the most informative.
     May be None if the optimal position is not known."""
@@ -48,6 +55,80 @@ class LabelmapSliceObservation(ArrayObservation[LabelmapStateAction]):
         return self._observation_space
 
 
+class LabelmapLabelImageObservation(ArrayObservation[LabelmapStateAction]):
+    def __init__(self, slice_shape: tuple[int, int], max_label: int = 255):
+        """
+        Observation consisting of the cropped labelmap slice as a compact uint8 label image.
+        Use :func:`image_navigation.util.img_processing.label_image_to_one_hot` for decoding on the learner side.
+
+        :param slice_shape: slices will be cropped to this shape (we need a consistent observation space).
+        :param max_label: the largest label value present in the labelmaps, at most 255. Slices with labels
+            outside of [0, max_label] raise a ValueError.
+        """
+        if not 0 <= max_label <= 255:
+            raise ValueError(f"max_label must be in [0, 255] to fit into uint8, got {max_label}")
+        self._slice_shape = slice_shape
+        self._max_label = max_label
+        self._observation_space = gym.spaces.Box(low=0, high=max_label, shape=slice_shape, dtype=np.uint8)
+
+    @property
+    def slice_shape(self) -> tuple[int, int]:
+        return self._slice_shape
+
+    def compute_observation(self, state: LabelmapStateAction) -> np.ndarray:
+        cropped_labelmap_slice = crop_center(state.labels_2d_slice, self.slice_shape)
+        # uint8 slices always fit, anything else would silently wrap around when casting
+        if (cropped_labelmap_slice.dtype != np.uint8 or self._max_label < 255) and cropped_labelmap_slice.size > 0:
+            min_label, max_label = cropped_labelmap_slice.min(), cropped_labelmap_slice.max()
+            if min_label < 0 or max_label > self._max_label:
+                raise ValueError(
+                    f"Label values must be in [0, {self._max_label}], got values in [{min_label}, {max_label}]"
+                )
+        return cropped_labelmap_slice.astype(np.uint8, copy=False)
+
+    @property
+    def observation_space(self) -> gym.spaces.Space[np.ndarray]:
+        """uint8 2-d array of label values."""
+        return self._observation_space
+
+
+class LabelmapBitPackedObservation(ArrayObservation[LabelmapStateAction]):
+    def __init__(self, slice_shape: tuple[int, int], labels: tuple[int, ...]):
+        """
+        Observation consisting of one binary channel per label (tissue) of the cropped labelmap slice,
+        with the bits of each channel packed along the width. Use
+        :func:`image_navigation.util.img_processing.unpack_label_channels` for decoding on the learner side.
+
+        :param slice_shape: slices will be cropped to this shape (we need a consistent observation space).
+        :param labels: the label values that get a channel, in channel order, e.g. (1, 2, 3) for
+            bones, tendons and the ulnar artery.
+        """
+        if not labels:
+            raise ValueError("labels must not be empty")
+        self._slice_shape = slice_shape
+        self._labels = tuple(labels)
+        height, width = slice_shape
+        packed_shape = (len(self._labels), height, (width + 7) // 8)
+        self._observation_space = gym.spaces.Box(low=0, high=255, shape=packed_shape, dtype=np.uint8)
+
+    @property
+    def slice_shape(self) -> tuple[int, int]:
+        return self._slice_shape
+
+    @property
+    def labels(self) -> tuple[int, ...]:
+        return self._labels
+
+    def compute_observation(self, state: LabelmapStateAction) -> np.ndarray:
+        cropped_labelmap_slice = crop_center(state.labels_2d_slice, self.slice_shape)
+        return pack_label_channels(cropped_labelmap_slice, self.labels)
+
+    @property
+    def observation_space(self) -> gym.spaces.Space[np.ndarray]:
+        """uint8 array of shape (n_labels, height, ceil(width / 8)) with bit-packed binary channels."""
+        return self._observation_space
+
+
 class LabelmapClusteringBasedReward(RewardMetric[LabelmapStateAction]):
     def compute_reward(self, state: TStateAction) -> float:
         # TODO: implement with DBSCAN or similar
@@ -62,6 +143,16 @@ class LabelmapEnvTerminationCriterion(TerminationCriterion['LabelmapEnv'], ABC):
     pass
 
 
+def action_to_slice_params(action: np.ndarray) -> tuple[float, float, np.ndarray]:
+    """
+    Splits an (unnormalized) action into the parameters of :func:`slice_volume`.
+
+    :param action: array of shape (5,) containing z-rotation, x-rotation and the 3D translation
+    :return: z-rotation, x-rotation, translation
+    """
+    return action[0], action[1], action[2:5]
+
+
 def unnormalize_rotation_translation(action: np.ndarray) -> np.ndarray:
     """
     Unnormalizes an array with values in the range [-1, 1] to the original range that is
@@ -75,7 +166,7 @@ def unnormalize_rotation_translation(action: np.ndarray) -> np.ndarray:
 
 
 class LabelmapEnv(ModularEnv[LabelmapStateAction, np.ndarray, np.ndarray]):
-    _INITIAL_POS_ROTATION = np.zeros(4)
+    _INITIAL_POS_ROTATION = np.zeros(5)
 
     def __init__(
         self,
@@ -84,6 +175,9 @@ class LabelmapEnv(ModularEnv[LabelmapStateAction, np.ndarray, np.ndarray]):
         reward_metric: RewardMetric[LabelmapStateAction] | None = None,
         termination_criterion: TerminationCriterion | None = None,
         max_episode_len: int | None = None,
+        observation: ArrayObservation[LabelmapStateAction] | None = None,
+        initial_state_sampler: CurriculumSampler | None = None,
+        occupancy_brick_size: int | None = None,
     ):
         """
 
@@ -92,18 +186,39 @@ class LabelmapEnv(ModularEnv[LabelmapStateAction, np.ndarray, np.ndarray]):
         :param reward_metric: if None, a default reward metric will be used
         :param termination_criterion: if None, no termination criterion will be used
         :param max_episode_len:
+        :param observation: if None, a :class:`LabelmapSliceObservation` of shape `slice_shape` will be used.
+            Pass e.g. a :class:`LabelmapBitPackedObservation` for compact observations.
+        :param initial_state_sampler: if given, the volume and the initial pose are sampled from it at reset and
+            the outcomes of episodes (terminated or truncated) are reported back to it. Only episodes that were
+            not restored from a snapshot are reported, so tree search and branching rollouts (including forks)
+            do not influence the curriculum. Otherwise, a volume is selected uniformly and the episode starts
+            at a fixed pose.
+        :param occupancy_brick_size: if given, slices are computed with a :class:`BrickOccupancyIndex` of this
+            brick size, which skips empty regions of the volumes and provides bounding boxes of the labels.
+            The indices are built lazily, once per volume.
         """
         if not name2volume:
             raise ValueError("name2volume must not be empty")
+        if initial_state_sampler is not None:
+            missing_names = set(initial_state_sampler.index.volume_names) - set(name2volume)
+            if missing_names:
+                raise ValueError(f"initial_state_sampler contains unknown volumes: {sorted(missing_names)}")
         reward_metric = reward_metric or LabelmapClusteringBasedReward()
-        observation = LabelmapSliceObservation(slice_shape)
+        observation = observation or LabelmapSliceObservation(slice_shape)
         super().__init__(reward_metric, observation, termination_criterion, max_episode_len)
         self.name2volume = name2volume
         self._slice_shape = slice_shape
+        self._labelmap_names = tuple(name2volume)
+        self.initial_state_sampler = initial_state_sampler
+        self.occupancy_brick_size = occupancy_brick_size
+        # shared with forks
+        self._name2occupancy_index: dict[str, BrickOccupancyIndex] = {}
 
         # set at reset
         self._cur_labelmap_name: str | None = None
         self._cur_labelmap_volume: sitk.Image | None = None
+        self._cur_initial_bin: int | None = None
+        """Difficulty bin of the initial pose, None if no outcome should be reported for the current episode."""
 
     @property
     def cur_labelmap_name(self) -> str | None:
@@ -123,36 +238,101 @@ class LabelmapEnv(ModularEnv[LabelmapStateAction, np.ndarray, np.ndarray]):
         self.name2volume = None
         self._cur_labelmap_name = None
         self._cur_labelmap_volume = None
+        self._cur_initial_bin = None
+        self._name2occupancy_index = {}
 
-    def _get_slice_from_action(self, action: np.ndarray) -> np.ndarray:
+    def _get_snapshot_extra(self) -> dict[str, Any]:
+        # only the key is stored, the volume itself is shared with all forks
+        return {"labelmap_name": self._cur_labelmap_name}
+
+    def _restore_snapshot_extra(self, extra: dict[str, Any]) -> None:
+        # the sampler is shared, outcomes of restored (branching) rollouts must not influence the curriculum
+        self._cur_initial_bin = None
+        labelmap_name = extra["labelmap_name"]
+        if labelmap_name is None:
+            self._cur_labelmap_name = None
+            self._cur_labelmap_volume = None
+            return
+        if self.name2volume is None or labelmap_name not in self.name2volume:
+            raise EnvPreconditionError(
+                f"Cannot restore snapshot: labelmap '{labelmap_name}' is not available. Was the env closed?"
+            )
+        self._cur_labelmap_name = labelmap_name
+        self._cur_labelmap_volume = self.name2volume[labelmap_name]
+
+    def get_slice(self, labelmap_name: str, action: np.ndarray) -> np.ndarray:
+        """Computes the slice of the given labelmap without changing the state of the env."""
+        return self._compute_slice(action, labelmap_name)[0]
+
+    def _get_occupancy_index(self, labelmap_name: str) -> BrickOccupancyIndex:
+        if labelmap_name not in self._name2occupancy_index:
+            self._name2occupancy_index[labelmap_name] = BrickOccupancyIndex(
+                self.name2volume[labelmap_name], brick_size=self.occupancy_brick_size
+            )
+        return self._name2occupancy_index[labelmap_name]
+
+    def _compute_slice(
+        self, action: np.ndarray, labelmap_name: str, num_threads: int | None = None
+    ) -> tuple[np.ndarray, dict[int, BBox | None] | None]:
+        """:return: the slice and, with sparse slicing, the bounding boxes of the labels in it"""
+        if self.occupancy_brick_size is None:
+            volume = self.name2volume[labelmap_name]
+            return self._get_slice_from_action(action, volume=volume, num_threads=num_threads), None
+        unnormalized_action = unnormalize_rotation_translation(action)
+        sparse_slice = self._get_occupancy_index(labelmap_name).slice(*action_to_slice_params(unnormalized_action))
+        return sparse_slice.labels_2d_slice, sparse_slice.label2bbox
+
+    def _get_slice_from_action(
+        self, action: np.ndarray, volume: sitk.Image | None = None, num_threads: int | None = None
+    ) -> np.ndarray:
+        if volume is None:
+            volume = self.cur_labelmap_volume
         # TODO: I'm not sure this is correct
         unnormalized_action = unnormalize_rotation_translation(action)
-        sliced_volume = slice_volume(*action, volume=self.cur_labelmap_volume)
+        sliced_volume = slice_volume(*action_to_slice_params(unnormalized_action), volume=volume,
+                                     num_threads=num_threads)
         sliced_img = sitk.GetArrayFromImage(sliced_volume)
         # TODO: sliced_img is 3D - why is that? Why do we take the zeroth channel?
         return sliced_img[:, 0, :]
 
-    def _get_initial_slice(self) -> np.ndarray:
-        return self._get_slice_from_action(self._INITIAL_POS_ROTATION)
+    def compute_state(
+        self, labelmap_name: str, action: np.ndarray, num_threads: int | None = None
+    ) -> LabelmapStateAction:
+        """
+        Computes the state reached by the action on the given labelmap without changing the state of the env.
+        The optimal position and labelmap are not set.
 
-    def compute_next_state(self, action: np.ndarray) -> LabelmapStateAction:
-        new_slice = self._get_slice_from_action(action)
+        :param num_threads: number of threads SimpleITK resamples with, see :func:`slice_volume`.
+            Not used with sparse slicing.
+        """
+        labels_2d_slice, label2bbox = self._compute_slice(action, labelmap_name, num_threads=num_threads)
         return LabelmapStateAction(
             action=action,
-            labels_2d_slice=new_slice,
-            optimal_position=self.cur_state_action.optimal_position,
-            optimal_labelmap=self.cur_state_action.optimal_labelmap,
+            labels_2d_slice=labels_2d_slice,
+            labelmap_name=labelmap_name,
+            label2bbox=label2bbox,
         )
 
+    def compute_next_state(self, action: np.ndarray) -> LabelmapStateAction:
+        next_state = self.compute_state(self.cur_labelmap_name, action)
+        next_state.optimal_position = self.cur_state_action.optimal_position
+        next_state.optimal_labelmap = self.cur_state_action.optimal_labelmap
+        return next_state
+
     def sample_initial_state(self) -> LabelmapStateAction:
-        sampled_image_name = np.random.choice(list(self.name2volume.keys()))
+        if self.initial_state_sampler is not None:
+            sampled_image_name, initial_action, self._cur_initial_bin = self.initial_state_sampler.sample()
+        else:
+            sampled_image_name = self._labelmap_names[self.np_random.integers(len(self._labelmap_names))]
+            initial_action = self._INITIAL_POS_ROTATION
         self._cur_labelmap_name = sampled_image_name
         self._cur_labelmap_volume = self.name2volume[sampled_image_name]
-        # Alternatively, select a random slice
-        initial_slice = self._get_initial_slice()
-        return LabelmapStateAction(
-            action=self._INITIAL_POS_ROTATION,
-            labels_2d_slice=initial_slice,
-            optimal_position=None,
-            optimal_labelmap=None,
-        )
+        return self.compute_state(sampled_image_name, initial_action)
+
+    def step(self, action: np.ndarray):
+        result = super().step(action)
+        if self._cur_initial_bin is not None and (self.is_terminated or self.is_truncated):
+            self.initial_state_sampler.update(self._cur_initial_bin, is_success=self.is_terminated)
+            # report each episode only once
+            self._cur_initial_bin = None
+        return result
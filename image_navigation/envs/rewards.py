@@ -0,0 +1,61 @@
+import numpy as np
+
+from image_navigation.distance_fields import TissueDistanceFields
+from image_navigation.envs.base import RewardMetric
+from image_navigation.envs.labelmaps_navigation import LabelmapStateAction, action_to_slice_params, \
+    unnormalize_rotation_translation
+from image_navigation.slicing import get_slice_voxel_indices
+
+
+class DistanceFieldReward(RewardMetric[LabelmapStateAction]):
+    def __init__(self, name2fields: dict[str, TissueDistanceFields], tissue_weights: dict[str, float] | None = None):
+        """
+        Smooth shaped reward based on precomputed distance fields, see
+        :func:`image_navigation.distance_fields.compute_distance_fields`. For each tissue, the smallest distance
+        between the slice plane and the tissue is looked up with a single gather per pixel, no clustering is
+        needed. The reward is one minus the weighted mean of these distances, normalized by the maximal distance.
+        It is 1 if the plane crosses all landmark tissues.
+
+        :param name2fields: mapping from labelmap names to their distance fields
+        :param tissue_weights: weights of the tissues, by default all tissues are weighted equally.
+            Tissues not in the mapping get a weight of zero.
+        """
+        if not name2fields:
+            raise ValueError("name2fields must not be empty")
+        if tissue_weights is not None:
+            for name, fields in name2fields.items():
+                if sum(tissue_weights.get(tissue, 0.0) for tissue in fields.tissue_names) <= 0:
+                    raise ValueError(
+                        f"The tissues of the distance fields of '{name}' ({', '.join(fields.tissue_names)}) "
+                        f"have no positive weight in tissue_weights {tissue_weights}"
+                    )
+        self.name2fields = name2fields
+        self.tissue_weights = tissue_weights
+
+    def _get_weights(self, fields: TissueDistanceFields) -> np.ndarray:
+        if self.tissue_weights is None:
+            return np.full(len(fields.tissue_names), 1 / len(fields.tissue_names))
+        weights = np.array([self.tissue_weights.get(name, 0.0) for name in fields.tissue_names])
+        return weights / weights.sum()
+
+    def compute_reward(self, state: LabelmapStateAction) -> float:
+        if state.labelmap_name is None:
+            raise ValueError("The state does not specify the labelmap it was taken from")
+        fields = self.name2fields[state.labelmap_name]
+        geometry = fields.geometry
+        voxel_indices, is_inside = get_slice_voxel_indices(
+            *action_to_slice_params(unnormalize_rotation_translation(state.action)),
+            origin=geometry.origin,
+            spacing=geometry.spacing,
+            direction=geometry.direction,
+            volume_size=geometry.size,
+        )
+        if not np.any(is_inside):
+            return 0.0
+        distances = fields.sample(voxel_indices[is_inside])
+        min_distances = distances.min(axis=1)
+        return float(1 - self._get_weights(fields) @ min_distances / fields.max_distance)
+
+    @property
+    def range(self) -> tuple[float, float]:
+        return 0.0, 1.0
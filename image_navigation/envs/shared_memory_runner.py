@@ -0,0 +1,328 @@
+import multiprocessing as mp
+import traceback
+from dataclasses import dataclass
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Sequence
+
+import gymnasium as gym
+import numpy as np
+
+from image_navigation.envs.base import EnvPreconditionError, ModularEnv
+
+
+class WorkerError(RuntimeError):
+    pass
+
+
+_CMD_RESET = 0
+_CMD_STEP = 1
+_CMD_CLOSE = 2
+
+_LIVENESS_CHECK_INTERVAL_S = 1.0
+_JOIN_TIMEOUT_S = 5.0
+
+
+@dataclass(frozen=True)
+class _SharedArraySpec:
+    shm_name: str
+    shape: tuple[int, ...]
+    dtype: np.dtype
+
+
+def _attach(spec: _SharedArraySpec) -> tuple[SharedMemory, np.ndarray]:
+    shm = SharedMemory(name=spec.shm_name)
+    return shm, np.ndarray(spec.shape, dtype=spec.dtype, buffer=shm.buf)
+
+
+def _worker(
+    index: int,
+    env_fn: Callable[[], ModularEnv],
+    specs: dict[str, _SharedArraySpec],
+    cmd_semaphore,
+    done_semaphore,
+    error_queue,
+    autoreset: bool,
+):
+    shms, arrays = [], {}
+    for name, spec in specs.items():
+        shm, arrays[name] = _attach(spec)
+        shms.append(shm)
+    control, actions, has_failed = arrays["control"], arrays["actions"], arrays["has_failed"]
+    observations, final_observations = arrays["observations"], arrays["final_observations"]
+    rewards, terminated, truncated = arrays["rewards"], arrays["terminated"], arrays["truncated"]
+
+    def report_error():
+        # the flag is set before signalling so that the main process knows how many errors to collect
+        has_failed[index] = True
+        error_queue.put((index, traceback.format_exc()))
+
+    env, construction_error = None, None
+    try:
+        env = env_fn()
+    except Exception:
+        # the worker keeps serving commands so that the main process does not block, but each of them fails
+        construction_error = traceback.format_exc()
+    try:
+        while True:
+            cmd_semaphore.acquire()
+            cmd, slot, seed = control[index]
+            if cmd == _CMD_CLOSE:
+                break
+            try:
+                if construction_error is not None:
+                    raise WorkerError(f"Env construction failed:\n{construction_error}")
+                if cmd == _CMD_RESET:
+                    obs, _ = env.reset(seed=None if seed < 0 else int(seed))
+                    reward, is_terminated, is_truncated = 0.0, False, False
+                else:
+                    obs, reward, is_terminated, is_truncated, _ = env.step(actions[index].copy())
+                    if autoreset and (is_terminated or is_truncated):
+                        final_observations[slot, index] = obs
+                        obs, _ = env.reset()
+                observations[slot, index] = obs
+                rewards[slot, index] = reward
+                terminated[slot, index] = is_terminated
+                truncated[slot, index] = is_truncated
+            except Exception:
+                report_error()
+            done_semaphore.release()
+    finally:
+        if env is not None:
+            env.close()
+        del control, actions, has_failed, observations, final_observations, rewards, terminated, truncated
+        arrays.clear()
+        for shm in shms:
+            shm.close()
+
+
+class SharedMemoryVectorRunner:
+    def __init__(
+        self,
+        env_fns: Sequence[Callable[[], ModularEnv]],
+        ring_size: int = 4,
+        autoreset: bool = True,
+        observation_space: gym.spaces.Box | None = None,
+        action_space: gym.spaces.Box | None = None,
+        start_method: str | None = None,
+    ):
+        """
+        Runs :class:`ModularEnv` instances in subprocesses. Instead of pickling results through pipes,
+        workers write observations, rewards and termination flags into preallocated shared-memory ring buffers
+        and signal completion through semaphores. Info dicts are not transported.
+
+        Arrays returned by :meth:`reset` and :meth:`step` are views into the ring buffer, i.e. no copies are made.
+        They stay valid for the next `ring_size - 1` calls, after which their slot is overwritten.
+
+        :param env_fns: one factory per worker. Factories are called in the worker processes, so they need
+            to be picklable for start methods other than fork.
+        :param ring_size: number of slots in the ring buffers
+        :param autoreset: if True, envs that terminated or were truncated are reset within the same step. The
+            returned observation is then the first one of the new episode, the last one of the finished episode
+            can be retrieved from :attr:`final_observations`.
+        :param observation_space: the observation space of the envs, must be a Box. If None, it is obtained
+            by instantiating and closing an env in the main process.
+        :param action_space: the action space of the envs, must be a Box. If None, obtained as above.
+        :param start_method: multiprocessing start method, see :func:`multiprocessing.get_context`
+        """
+        if not env_fns:
+            raise ValueError("env_fns must not be empty")
+        if ring_size < 1:
+            raise ValueError(f"ring_size must be positive, got {ring_size}")
+        if observation_space is None or action_space is None:
+            env = env_fns[0]()
+            observation_space = observation_space or env.observation_space
+            action_space = action_space or env.action_space
+            env.close()
+        for space in (observation_space, action_space):
+            if not isinstance(space, gym.spaces.Box):
+                raise TypeError(f"Only Box spaces can be transported through shared memory, got {space}")
+
+        self.num_envs = len(env_fns)
+        self.ring_size = ring_size
+        self.single_observation_space = observation_space
+        self.single_action_space = action_space
+
+        n = self.num_envs
+        buffer_layouts = {
+            # command, slot, seed (negative for None)
+            "control": ((n, 3), np.int64),
+            "has_failed": ((n,), np.bool_),
+            "actions": ((n, *action_space.shape), action_space.dtype),
+            "observations": ((ring_size, n, *observation_space.shape), observation_space.dtype),
+            "final_observations": ((ring_size, n, *observation_space.shape), observation_space.dtype),
+            "rewards": ((ring_size, n), np.float64),
+            "terminated": ((ring_size, n), np.bool_),
+            "truncated": ((ring_size, n), np.bool_),
+        }
+        self._shms: dict[str, SharedMemory] = {}
+        self._arrays: dict[str, np.ndarray] = {}
+        specs = {}
+        for name, (shape, dtype) in buffer_layouts.items():
+            dtype = np.dtype(dtype)
+            shm = SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+            self._shms[name] = shm
+            self._arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            self._arrays[name].fill(0)
+            specs[name] = _SharedArraySpec(shm_name=shm.name, shape=shape, dtype=dtype)
+
+        ctx = mp.get_context(start_method)
+        self._cmd_semaphores = [ctx.Semaphore(0) for _ in range(n)]
+        self._done_semaphore = ctx.Semaphore(0)
+        self._error_queue = ctx.Queue()
+        self._processes = []
+        for index, env_fn in enumerate(env_fns):
+            process = ctx.Process(
+                target=_worker,
+                args=(
+                    index,
+                    env_fn,
+                    specs,
+                    self._cmd_semaphores[index],
+                    self._done_semaphore,
+                    self._error_queue,
+                    autoreset,
+                ),
+                daemon=True,
+            )
+            process.start()
+            self._processes.append(process)
+
+        self._cur_slot = -1
+        self._is_waiting = False
+        self._is_closed = False
+        self._dead_workers_message: str | None = None
+
+    @property
+    def is_closed(self) -> bool:
+        return self._is_closed
+
+    @property
+    def final_observations(self) -> np.ndarray:
+        """Last observations of the episodes that ended in the latest step. Only valid where terminated or truncated."""
+        self._assert_has_results()
+        return self._arrays["final_observations"][self._cur_slot]
+
+    def _assert_open(self):
+        if self._is_closed:
+            raise EnvPreconditionError("The runner has been closed.")
+        if self._dead_workers_message is not None:
+            raise WorkerError(self._dead_workers_message)
+
+    def _get_dead_workers_message(self) -> str | None:
+        dead_workers = [
+            f"worker {index} (exit code {process.exitcode})"
+            for index, process in enumerate(self._processes)
+            if process.exitcode is not None
+        ]
+        if not dead_workers:
+            return None
+        return f"{', '.join(dead_workers)} died unexpectedly. The runner is unusable, call close()."
+
+    def _acquire_done_signals(self) -> bool:
+        """
+        Waits until all workers signalled completion, checking regularly whether all of them are alive.
+
+        :return: False if a worker died in the meantime
+        """
+        num_remaining = self.num_envs
+        while num_remaining > 0:
+            if self._done_semaphore.acquire(timeout=_LIVENESS_CHECK_INTERVAL_S):
+                num_remaining -= 1
+                continue
+            self._dead_workers_message = self._get_dead_workers_message()
+            if self._dead_workers_message is not None:
+                return False
+        return True
+
+    def _assert_has_results(self):
+        if self._cur_slot < 0:
+            raise EnvPreconditionError("No results available. Did you call reset()?")
+
+    def _send(self, cmd: int, seeds: Sequence[int | None] | None = None):
+        self._assert_open()
+        if self._is_waiting:
+            raise EnvPreconditionError("Previous call has not been awaited, call step_wait() first.")
+        self._cur_slot = (self._cur_slot + 1) % self.ring_size
+        control = self._arrays["control"]
+        control[:, 0] = cmd
+        control[:, 1] = self._cur_slot
+        control[:, 2] = [-1 if seed is None else seed for seed in (seeds or [None] * self.num_envs)]
+        for semaphore in self._cmd_semaphores:
+            semaphore.release()
+        self._is_waiting = True
+
+    def _wait(self):
+        is_complete = self._acquire_done_signals()
+        self._is_waiting = False
+        if not is_complete:
+            raise WorkerError(self._dead_workers_message)
+        has_failed = self._arrays["has_failed"]
+        if has_failed.any():
+            errors = [self._error_queue.get() for _ in range(int(has_failed.sum()))]
+            has_failed[:] = False
+            message = "\n".join(f"Worker {index}:\n{tb}" for index, tb in errors)
+            raise WorkerError(f"{len(errors)} worker(s) raised an exception:\n{message}")
+
+    def _cur_results(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        slot = self._cur_slot
+        return (
+            self._arrays["observations"][slot],
+            self._arrays["rewards"][slot],
+            self._arrays["terminated"][slot],
+            self._arrays["truncated"][slot],
+        )
+
+    def reset(self, seed: int | None = None) -> np.ndarray:
+        """
+        :param seed: if not None, worker i is reset with seed `seed + i`
+        :return: observations of shape (num_envs, *observation_shape)
+        """
+        seeds = None if seed is None else [seed + i for i in range(self.num_envs)]
+        self._send(_CMD_RESET, seeds)
+        self._wait()
+        return self._cur_results()[0]
+
+    def step_async(self, actions: np.ndarray):
+        self._assert_has_results()
+        self._arrays["actions"][:] = actions
+        self._send(_CMD_STEP)
+
+    def step_wait(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: observations, rewards, terminated and truncated flags, each with leading dimension num_envs
+        """
+        if not self._is_waiting:
+            raise EnvPreconditionError("No step in progress, call step_async() first.")
+        self._wait()
+        return self._cur_results()
+
+    def step(self, actions: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        if self._is_closed:
+            return
+        if self._is_waiting:
+            # dead workers will never signal, the others are asked to close below anyway
+            self._acquire_done_signals()
+            self._is_waiting = False
+        self._arrays["control"][:, 0] = _CMD_CLOSE
+        for semaphore in self._cmd_semaphores:
+            semaphore.release()
+        for process in self._processes:
+            process.join(timeout=_JOIN_TIMEOUT_S)
+            if process.exitcode is None:
+                process.terminate()
+                process.join()
+        self._arrays.clear()
+        for shm in self._shms.values():
+            shm.close()
+            shm.unlink()
+        self._is_closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,466 @@
+"""
+Cohort-wide policy evaluation. Evaluation jobs, i.e. (volume, seed, episode) triples, are put on a work queue and
+processed by any number of worker processes, possibly on several machines. Per-episode metrics are streamed
+into a results directory in the json-lines format, one file per worker, and merged into a single file
+at the end of :func:`run_evaluation`.
+
+The :class:`FileWorkQueue` is a simple broker based on atomic renames in a directory. It stands in for a real one
+and works across machines as long as they share the directory (with a file system that has atomic renames).
+"""
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import socket
+import threading
+import time
+import traceback
+import warnings
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Iterable
+
+import numpy as np
+
+from image_navigation.envs.base import ModularEnv, StateAction
+
+Policy = Callable[[Any], Any]
+"""Maps an observation to an action."""
+
+_HEARTBEAT_INTERVAL_S = 30.0
+
+
+@dataclass(frozen=True, kw_only=True)
+class EvaluationJob:
+    volume_name: str
+    seed: int
+    episode: int
+
+    @property
+    def job_id(self) -> str:
+        key = json.dumps([self.volume_name, self.seed, self.episode])
+        return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+    @property
+    def reset_seed(self) -> int:
+        """Seed used for resetting the env, derived from seed and episode."""
+        return int(np.random.SeedSequence([self.seed, self.episode]).generate_state(1)[0])
+
+
+@dataclass(kw_only=True)
+class ClaimedJob:
+    job: EvaluationJob
+    attempt: int
+    """Number of previous failed attempts"""
+    errors: list[str] = field(default_factory=list)
+
+
+@dataclass(kw_only=True)
+class EpisodeResult:
+    volume_name: str
+    seed: int
+    episode: int
+    num_steps: int
+    episode_return: float
+    final_reward: float
+    final_loss: float | None
+    """Only computed if a loss function was passed to the worker."""
+    steps_to_standard_plane: int | None
+    """Number of steps until the env terminated, None if it did not terminate."""
+    mean_step_latency_s: float
+    """Mean wall time of policy inference and env step."""
+    max_step_latency_s: float
+    episode_time_s: float
+    worker_id: str
+    attempt: int
+
+
+class FileWorkQueue:
+    def __init__(self, root: str | Path, max_attempts: int = 3):
+        """
+        Work queue backed by a directory. Each job is a json file that moves between the subdirectories
+        `pending`, `claimed`, `done` and `failed`. Claiming a job is an atomic rename, so several processes
+        can consume the queue concurrently.
+
+        :param root: directory of the queue, will be created if it does not exist
+        :param max_attempts: jobs that failed this many times are moved to `failed` instead of being requeued
+        """
+        if max_attempts < 1:
+            raise ValueError(f"max_attempts must be positive, got {max_attempts}")
+        self.root = Path(root)
+        self.max_attempts = max_attempts
+        for directory in (self._pending_dir, self._claimed_dir, self._done_dir, self._failed_dir):
+            directory.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def _pending_dir(self) -> Path:
+        return self.root / "pending"
+
+    @property
+    def _claimed_dir(self) -> Path:
+        return self.root / "claimed"
+
+    @property
+    def _done_dir(self) -> Path:
+        return self.root / "done"
+
+    @property
+    def _failed_dir(self) -> Path:
+        return self.root / "failed"
+
+    @staticmethod
+    def _file_name(job: EvaluationJob) -> str:
+        return f"{job.job_id}.json"
+
+    @staticmethod
+    def _write(path: Path, claimed_job: ClaimedJob):
+        tmp_path = path.with_suffix(f".tmp{os.getpid()}")
+        tmp_path.write_text(json.dumps(asdict(claimed_job)))
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _read(path: Path) -> ClaimedJob:
+        content = json.loads(path.read_text())
+        return ClaimedJob(job=EvaluationJob(**content["job"]), attempt=content["attempt"], errors=content["errors"])
+
+    def put(self, job: EvaluationJob) -> bool:
+        """
+        Adds the job to the queue unless it is already known, e.g. because it was completed in a previous run.
+
+        :return: whether the job was added
+        """
+        file_name = self._file_name(job)
+        for directory in (self._pending_dir, self._claimed_dir, self._done_dir, self._failed_dir):
+            if (directory / file_name).exists():
+                return False
+        self._write(self._pending_dir / file_name, ClaimedJob(job=job, attempt=0))
+        return True
+
+    def put_all(self, jobs: Iterable[EvaluationJob]) -> int:
+        """:return: the number of jobs that were added"""
+        return sum(self.put(job) for job in jobs)
+
+    def claim(self) -> ClaimedJob | None:
+        """:return: a pending job, which is now exclusively owned by the caller, or None if there is none"""
+        for file_name in sorted(os.listdir(self._pending_dir)):
+            if not file_name.endswith(".json"):
+                continue
+            claimed_path = self._claimed_dir / file_name
+            try:
+                os.rename(self._pending_dir / file_name, claimed_path)
+            except FileNotFoundError:
+                # claimed by someone else in the meantime
+                continue
+            # mark the claim time for requeue_stale
+            os.utime(claimed_path)
+            return self._read(claimed_path)
+        return None
+
+    def heartbeat(self, claimed_job: ClaimedJob):
+        """Refreshes the claim time, so that :meth:`requeue_stale` does not consider the job abandoned."""
+        try:
+            os.utime(self._claimed_dir / self._file_name(claimed_job.job))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, claimed_job: ClaimedJob):
+        """
+        Marks the job as done. If the claim was lost, e.g. because it was requeued and another worker completed
+        the job first, nothing happens. Duplicate results are resolved by :func:`load_results`.
+        """
+        file_name = self._file_name(claimed_job.job)
+        try:
+            os.replace(self._claimed_dir / file_name, self._done_dir / file_name)
+        except FileNotFoundError:
+            pass
+
+    def fail(self, claimed_job: ClaimedJob, error: str) -> bool:
+        """
+        Requeues the job, or moves it to `failed` if it has exhausted its attempts. If the claim was lost,
+        nothing happens.
+
+        :return: whether the job was requeued
+        """
+        file_name = self._file_name(claimed_job.job)
+        # take the claim file out of reach of other workers first, so a lost claim is never resurrected
+        failing_path = self._claimed_dir / f"{file_name}.failing{os.getpid()}"
+        try:
+            os.rename(self._claimed_dir / file_name, failing_path)
+        except FileNotFoundError:
+            return False
+        claimed_job = ClaimedJob(
+            job=claimed_job.job, attempt=claimed_job.attempt + 1, errors=[*claimed_job.errors, error]
+        )
+        self._write(failing_path, claimed_job)
+        is_requeued = claimed_job.attempt < self.max_attempts
+        target_dir = self._pending_dir if is_requeued else self._failed_dir
+        os.replace(failing_path, target_dir / file_name)
+        return is_requeued
+
+    def requeue_stale(self, max_age_s: float = 0.0) -> int:
+        """
+        Moves jobs that were claimed (or last refreshed by :meth:`heartbeat`) more than `max_age_s` seconds ago
+        back to pending. Use this for resuming after workers died. With the default of 0, all claimed jobs are
+        requeued, which is only safe if no worker is running.
+
+        :return: the number of requeued jobs
+        """
+        now = time.time()
+        num_requeued = 0
+        for file_name in os.listdir(self._claimed_dir):
+            if not file_name.endswith(".json"):
+                continue
+            claimed_path = self._claimed_dir / file_name
+            try:
+                if now - claimed_path.stat().st_mtime < max_age_s:
+                    continue
+                os.rename(claimed_path, self._pending_dir / file_name)
+            except FileNotFoundError:
+                continue
+            num_requeued += 1
+        return num_requeued
+
+    def counts(self) -> dict[str, int]:
+        return {
+            directory.name: sum(f.endswith(".json") for f in os.listdir(directory))
+            for directory in (self._pending_dir, self._claimed_dir, self._done_dir, self._failed_dir)
+        }
+
+    def failed_jobs(self) -> list[ClaimedJob]:
+        return [self._read(path) for path in sorted(self._failed_dir.glob("*.json"))]
+
+
+def create_cohort_jobs(
+    volume_names: Iterable[str], seeds: Iterable[int], episodes_per_seed: int = 1
+) -> list[EvaluationJob]:
+    seeds = list(seeds)
+    return [
+        EvaluationJob(volume_name=volume_name, seed=seed, episode=episode)
+        for volume_name in volume_names
+        for seed in seeds
+        for episode in range(episodes_per_seed)
+    ]
+
+
+MERGED_RESULTS_FILE_NAME = "results.jsonl"
+
+
+def _worker_results_dir(results_dir: str | Path) -> Path:
+    return Path(results_dir) / "workers"
+
+
+def append_result(results_dir: str | Path, result: EpisodeResult):
+    """
+    Appends the result as a single line to the results file of its worker in `results_dir`. Each file has
+    a single writer, so this does not rely on atomic appends, which e.g. NFS does not provide.
+    """
+    worker_results_dir = _worker_results_dir(results_dir)
+    worker_results_dir.mkdir(parents=True, exist_ok=True)
+    with open(worker_results_dir / f"{result.worker_id}.jsonl", "a") as f:
+        f.write(json.dumps(asdict(result)) + "\n")
+
+
+def write_merged_results(results_dir: str | Path) -> list[EpisodeResult]:
+    """
+    Writes the results of all workers, as returned by :func:`load_results`, to the single file
+    `results_dir/results.jsonl`. The file is replaced atomically, so readers never see a partial file.
+
+    :return: the merged results
+    """
+    results = load_results(results_dir)
+    merged_path = Path(results_dir) / MERGED_RESULTS_FILE_NAME
+    tmp_path = merged_path.with_suffix(f".tmp{os.getpid()}")
+    tmp_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path.write_text("".join(json.dumps(asdict(result)) + "\n" for result in results))
+    os.replace(tmp_path, merged_path)
+    return results
+
+
+def load_results(results_dir: str | Path) -> list[EpisodeResult]:
+    """
+    Reads and merges the results of all workers. If a job was completed more than once, e.g. after a worker died
+    between writing the result and marking the job as done, only the result of the latest attempt is kept.
+    Incomplete lines, as left by a worker that died while writing, are skipped.
+    """
+    worker_results_dir = _worker_results_dir(results_dir)
+    if not worker_results_dir.exists():
+        return []
+    key2result = {}
+    for path in sorted(worker_results_dir.glob("*.jsonl")):
+        with open(path) as f:
+            for line in f:
+                try:
+                    result = EpisodeResult(**json.loads(line))
+                except (json.JSONDecodeError, TypeError):
+                    continue
+                key = (result.volume_name, result.seed, result.episode)
+                if key not in key2result or result.attempt >= key2result[key].attempt:
+                    key2result[key] = result
+    return list(key2result.values())
+
+
+def evaluate_episode(
+    env: ModularEnv,
+    policy: Policy,
+    job: EvaluationJob,
+    max_steps: int,
+    loss_fn: Callable[[StateAction], float] | None = None,
+    worker_id: str = "",
+    attempt: int = 0,
+) -> EpisodeResult:
+    """
+    Runs a single episode until the env terminates, is truncated or `max_steps` steps were taken.
+
+    :param loss_fn: if given, used to compute the loss of the final state
+    """
+    episode_start = time.perf_counter()
+    observation, _ = env.reset(seed=job.reset_seed)
+    episode_return = 0.0
+    step_latencies = []
+    steps_to_standard_plane = None
+    while len(step_latencies) < max_steps and not (env.is_terminated or env.is_truncated):
+        step_start = time.perf_counter()
+        action = policy(observation)
+        observation, reward, is_terminated, _, _ = env.step(action)
+        step_latencies.append(time.perf_counter() - step_start)
+        episode_return += reward
+        if is_terminated:
+            steps_to_standard_plane = len(step_latencies)
+    return EpisodeResult(
+        volume_name=job.volume_name,
+        seed=job.seed,
+        episode=job.episode,
+        num_steps=len(step_latencies),
+        episode_return=float(episode_return),
+        final_reward=float(env.cur_reward),
+        final_loss=None if loss_fn is None else float(loss_fn(env.cur_state_action)),
+        steps_to_standard_plane=steps_to_standard_plane,
+        mean_step_latency_s=float(np.mean(step_latencies)) if step_latencies else 0.0,
+        max_step_latency_s=float(np.max(step_latencies)) if step_latencies else 0.0,
+        episode_time_s=time.perf_counter() - episode_start,
+        worker_id=worker_id,
+        attempt=attempt,
+    )
+
+
+def _send_heartbeats(queue: FileWorkQueue, claimed_job: ClaimedJob, stop_event: threading.Event):
+    while not stop_event.wait(_HEARTBEAT_INTERVAL_S):
+        queue.heartbeat(claimed_job)
+
+
+def run_evaluation_worker(
+    queue: FileWorkQueue,
+    env_fn: Callable[[str], ModularEnv],
+    policy_fn: Callable[[], Policy],
+    results_dir: str | Path,
+    max_steps: int,
+    loss_fn: Callable[[StateAction], float] | None = None,
+    worker_id: str | None = None,
+) -> int:
+    """
+    Processes jobs from the queue until it is empty. Can be started directly on any machine that has
+    access to the queue directory and the results directory.
+
+    :param env_fn: creates an env that evaluates on the volume with the given name. Envs are cached per volume
+        for the lifetime of the worker.
+    :param policy_fn: creates the policy, e.g. by loading a checkpoint. Called once per worker.
+    :return: the number of completed jobs
+    """
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    policy = policy_fn()
+    name2env: dict[str, ModularEnv] = {}
+    num_completed = 0
+    try:
+        while (claimed_job := queue.claim()) is not None:
+            job = claimed_job.job
+            # keeps the claim alive during long episodes
+            stop_heartbeats = threading.Event()
+            heartbeat_thread = threading.Thread(
+                target=_send_heartbeats, args=(queue, claimed_job, stop_heartbeats), daemon=True
+            )
+            heartbeat_thread.start()
+            try:
+                if job.volume_name not in name2env:
+                    name2env[job.volume_name] = env_fn(job.volume_name)
+                result = evaluate_episode(
+                    name2env[job.volume_name],
+                    policy,
+                    job,
+                    max_steps,
+                    loss_fn=loss_fn,
+                    worker_id=worker_id,
+                    attempt=claimed_job.attempt,
+                )
+            except Exception:
+                # the env may be in an inconsistent state
+                env = name2env.pop(job.volume_name, None)
+                if env is not None:
+                    env.close()
+                queue.fail(claimed_job, traceback.format_exc())
+                continue
+            finally:
+                stop_heartbeats.set()
+                heartbeat_thread.join()
+            append_result(results_dir, result)
+            queue.complete(claimed_job)
+            num_completed += 1
+    finally:
+        for env in name2env.values():
+            env.close()
+    return num_completed
+
+
+def run_evaluation(
+    queue: FileWorkQueue,
+    env_fn: Callable[[str], ModularEnv],
+    policy_fn: Callable[[], Policy],
+    results_dir: str | Path,
+    max_steps: int,
+    num_workers: int,
+    loss_fn: Callable[[StateAction], float] | None = None,
+    requeue_stale_after_s: float | None = None,
+    start_method: str | None = None,
+) -> list[EpisodeResult]:
+    """
+    Processes all jobs on the queue with `num_workers` local processes, merges all results from the results
+    directory into `results_dir/results.jsonl` (see :func:`write_merged_results`) and returns them. Calling this
+    again with the same queue resumes the evaluation, completed jobs are not repeated. For evaluation on several
+    machines, call :func:`run_evaluation_worker` (or this function) on each of them.
+
+    :param requeue_stale_after_s: if given, claims older than this are considered abandoned (e.g. by a crashed run)
+        and are requeued before starting. Workers refresh their claims every 30 seconds, so if other workers consume
+        the same queue, e.g. on other machines, pick an age well above that. 0 requeues all claims and is only safe
+        if no other worker runs.
+    :param start_method: multiprocessing start method, see :func:`multiprocessing.get_context`
+    :raises RuntimeError: if a worker process crashed. Results of completed jobs are kept.
+    """
+    if num_workers < 1:
+        raise ValueError(f"num_workers must be positive, got {num_workers}")
+    if requeue_stale_after_s is not None:
+        queue.requeue_stale(requeue_stale_after_s)
+    worker_args = (queue, env_fn, policy_fn, results_dir, max_steps, loss_fn)
+    if num_workers == 1:
+        run_evaluation_worker(*worker_args)
+    else:
+        ctx = mp.get_context(start_method)
+        processes = [ctx.Process(target=run_evaluation_worker, args=worker_args) for _ in range(num_workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        crashed = [f"worker {i} (exit code {p.exitcode})" for i, p in enumerate(processes) if p.exitcode != 0]
+        if crashed:
+            counts = queue.counts()
+            raise RuntimeError(
+                f"{', '.join(crashed)} crashed, leaving {counts['pending']} pending and {counts['claimed']} claimed "
+                "jobs. Call run_evaluation again with requeue_stale_after_s to resume."
+            )
+    counts = queue.counts()
+    if counts["pending"] or counts["claimed"]:
+        # e.g. jobs added or still processed by workers on other machines
+        warnings.warn(
+            f"The queue still has {counts['pending']} pending and {counts['claimed']} claimed jobs, "
+            "the returned results are incomplete."
+        )
+    return write_merged_results(results_dir)
+
@@ -0,0 +1,274 @@
+import functools
+import multiprocessing as mp
+import queue
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass, replace
+from typing import Any, Callable, Iterable, Iterator, Sequence
+
+import numpy as np
+
+from image_navigation.envs.labelmaps_navigation import LabelmapEnv, LabelmapStateAction
+from image_navigation.loss import loss_fct
+from image_navigation.tissue_clustering import Tissues
+
+_POLL_INTERVAL_S = 0.1
+
+
+@dataclass(kw_only=True)
+class PipelineStage:
+    name: str
+    fn: Callable[[Any], Any]
+    """Processes the output of the previous stage (or an input item for the first stage)."""
+    num_workers: int = 1
+    queue_size: int = 8
+    """Capacity of the input queue of the stage. Upstream stages block when it is full."""
+    use_processes: bool = False
+    """
+    If True, fn is run in a pool of `num_workers` processes instead of threads. Use this for stages that hold
+    the GIL, e.g. pure python code. fn, its inputs and its outputs must be picklable.
+    """
+
+
+@dataclass(kw_only=True)
+class StageMetrics:
+    name: str
+    num_processed: int = 0
+    busy_time_s: float = 0.0
+    """Summed processing time over all workers of the stage."""
+    cur_queue_depth: int = 0
+    max_queue_depth: int = 0
+    mean_queue_depth: float = 0.0
+    """Mean depth of the input queue, sampled whenever a worker takes an item."""
+
+
+@dataclass
+class _Failure:
+    exception: BaseException
+
+
+class StreamingPipeline:
+    def __init__(
+        self, stages: Sequence[PipelineStage], max_in_flight: int | None = None, start_method: str = "spawn"
+    ):
+        """
+        Runs items through a sequence of stages. Each stage has its own pool of workers and a bounded input queue,
+        so all stages work concurrently and the throughput approaches that of the slowest stage. Workers are
+        threads by default, which only run in parallel if the stage releases the GIL, like SimpleITK resampling.
+        Stages that hold the GIL should set :attr:`PipelineStage.use_processes`. Every item pays a small overhead
+        for passing through the queues, so stages should do at least a few milliseconds of work per item.
+
+        :param stages: the stages, in order
+        :param max_in_flight: maximal number of items that have been taken from the input but not yet yielded.
+            Bounds the memory of the reordering buffer. Defaults to the total capacity of queues and workers.
+        :param start_method: multiprocessing start method of the process stages, see
+            :func:`multiprocessing.get_context`. Their processes start while other stages already run in threads,
+            and forking a multi-threaded process (e.g. one holding SimpleITK locks) can deadlock. With the default
+            "spawn", the main module must be importable without side effects (`if __name__ == "__main__":`).
+        """
+        if not stages:
+            raise ValueError("stages must not be empty")
+        self.stages = list(stages)
+        self.max_in_flight = max_in_flight or sum(stage.queue_size + stage.num_workers for stage in stages)
+        self.start_method = start_method
+        self._metrics = [StageMetrics(name=stage.name) for stage in stages]
+        self._queue_depth_sums = [0] * len(stages)
+        self._metrics_lock = threading.Lock()
+        self._queues: list[queue.Queue] = []
+
+    @property
+    def stage_metrics(self) -> list[StageMetrics]:
+        """Snapshot of the metrics of each stage, can be queried while the pipeline is running."""
+        with self._metrics_lock:
+            metrics = []
+            for i, stage_metrics in enumerate(self._metrics):
+                cur_queue_depth = self._queues[i].qsize() if self._queues else 0
+                metrics.append(replace(stage_metrics, cur_queue_depth=cur_queue_depth))
+            return metrics
+
+    def _record(self, stage_idx: int, queue_depth: int, busy_time_s: float):
+        with self._metrics_lock:
+            stage_metrics = self._metrics[stage_idx]
+            stage_metrics.num_processed += 1
+            stage_metrics.busy_time_s += busy_time_s
+            stage_metrics.max_queue_depth = max(stage_metrics.max_queue_depth, queue_depth)
+            self._queue_depth_sums[stage_idx] += queue_depth
+            stage_metrics.mean_queue_depth = self._queue_depth_sums[stage_idx] / stage_metrics.num_processed
+
+    @staticmethod
+    def _put(target: queue.Queue, item: Any, stop_event: threading.Event) -> bool:
+        """Blocks while the queue is full. :return: False if the pipeline was stopped in the meantime"""
+        while not stop_event.is_set():
+            try:
+                target.put(item, timeout=_POLL_INTERVAL_S)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    @staticmethod
+    def _get(source: queue.Queue, stop_event: threading.Event) -> tuple[bool, Any]:
+        while not stop_event.is_set():
+            try:
+                return True, source.get(timeout=_POLL_INTERVAL_S)
+            except queue.Empty:
+                continue
+        return False, None
+
+    def _work(self, stage_idx: int, source: queue.Queue, target: queue.Queue, stop_event: threading.Event,
+              executor: Executor | None):
+        fn = self.stages[stage_idx].fn
+        while True:
+            queue_depth = source.qsize()
+            is_ok, entry = self._get(source, stop_event)
+            if not is_ok:
+                return
+            seq, value = entry
+            start = time.perf_counter()
+            if not isinstance(value, _Failure):
+                try:
+                    value = fn(value) if executor is None else executor.submit(fn, value).result()
+                except Exception as e:
+                    value = _Failure(e)
+            self._record(stage_idx, queue_depth, time.perf_counter() - start)
+            if not self._put(target, (seq, value), stop_event):
+                return
+
+    def _feed(self, items: Iterable, target: queue.Queue, in_flight: threading.Semaphore,
+              stop_event: threading.Event, num_items_result: list[int]):
+        num_items = 0
+        try:
+            for item in items:
+                while not in_flight.acquire(timeout=_POLL_INTERVAL_S):
+                    if stop_event.is_set():
+                        return
+                if not self._put(target, (num_items, item), stop_event):
+                    return
+                num_items += 1
+        except Exception as e:
+            # surfaces in order, after all items that were read successfully
+            self._put(target, (num_items, _Failure(e)), stop_event)
+            num_items += 1
+        finally:
+            # signals the end of the input to the consumer
+            num_items_result.append(num_items)
+
+    def run(self, items: Iterable) -> Iterator[Any]:
+        """
+        Processes the items and yields the outputs of the last stage in the order of the items.
+        If a stage raises for an item, the exception is raised when that item would have been yielded.
+        Closing the generator early stops all workers.
+        """
+        self._queues = [queue.Queue(maxsize=stage.queue_size) for stage in self.stages]
+        output_queue = queue.Queue()
+        num_items_result = []
+        stop_event = threading.Event()
+        in_flight = threading.Semaphore(self.max_in_flight)
+
+        # each thread of a process stage forwards one item at a time to the pool
+        executors = [
+            ProcessPoolExecutor(max_workers=stage.num_workers, mp_context=mp.get_context(self.start_method))
+            if stage.use_processes else None
+            for stage in self.stages
+        ]
+        feed_args = (items, self._queues[0], in_flight, stop_event, num_items_result)
+        threads = [threading.Thread(target=self._feed, args=feed_args, daemon=True)]
+        for stage_idx, stage in enumerate(self.stages):
+            target = self._queues[stage_idx + 1] if stage_idx + 1 < len(self.stages) else output_queue
+            work_args = (stage_idx, self._queues[stage_idx], target, stop_event, executors[stage_idx])
+            threads += [
+                threading.Thread(target=self._work, args=work_args, daemon=True) for _ in range(stage.num_workers)
+            ]
+        for thread in threads:
+            thread.start()
+
+        seq2value = {}
+        next_seq = 0
+        try:
+            while not num_items_result or next_seq < num_items_result[0]:
+                if next_seq not in seq2value:
+                    try:
+                        seq, value = output_queue.get(timeout=_POLL_INTERVAL_S)
+                    except queue.Empty:
+                        continue
+                    seq2value[seq] = value
+                    continue
+                value = seq2value.pop(next_seq)
+                next_seq += 1
+                in_flight.release()
+                if isinstance(value, _Failure):
+                    raise value.exception
+                yield value
+        finally:
+            stop_event.set()
+            for thread in threads:
+                thread.join()
+            for executor in executors:
+                if executor is not None:
+                    executor.shutdown(cancel_futures=True)
+
+
+@dataclass(kw_only=True)
+class LabelmapPipelineResult:
+    state_action: LabelmapStateAction
+    tissue_clusters: dict
+    reward: float
+
+
+def _cluster(tissues: Tissues, state_action: LabelmapStateAction) -> tuple[LabelmapStateAction, dict]:
+    return state_action, tissues.cluster_iter(state_action.labels_2d_slice, state_action.label2bbox)
+
+
+def create_labelmap_pipeline(
+    env: LabelmapEnv,
+    tissues: Tissues,
+    reward_fn: Callable[[LabelmapStateAction, dict], float] | None = None,
+    num_slicing_workers: int = 2,
+    num_clustering_workers: int = 2,
+    num_reward_workers: int = 1,
+    queue_size: int = 8,
+    cluster_in_processes: bool = False,
+    num_sitk_threads: int | None = 1,
+) -> StreamingPipeline:
+    """
+    Pipeline for offline evaluation of pre-generated actions, e.g. recorded trajectories or open-loop sweeps.
+    Input items are tuples (labelmap_name, action), outputs are :class:`LabelmapPipelineResult`. Slicing,
+    clustering and reward computation run in separate stages. The state of the env is not changed.
+
+    :param env: used for slicing, see :meth:`LabelmapEnv.compute_state`. With `occupancy_brick_size` set,
+        clustering is restricted to the bounding boxes of the tissues.
+    :param tissues: the tissues to cluster
+    :param reward_fn: computes the reward from the state and the clusters. Defaults to :func:`loss_fct`
+        of the clusters.
+    :param cluster_in_processes: run the clustering workers in processes, see :attr:`PipelineStage.use_processes`.
+        Clustering mostly holds the GIL, so this pays off on machines with enough cores, for large slices.
+    :param num_sitk_threads: number of threads each slicing worker resamples with. SimpleITK uses all cores
+        by default, so several slicing workers would oversubscribe them. With the default of 1,
+        `num_slicing_workers` controls the parallelism of slicing. None uses SimpleITK's global default.
+    """
+    reward_fn = reward_fn or (lambda state_action, tissue_clusters: loss_fct(tissue_clusters))
+
+    def compute_state(item: tuple[str, np.ndarray]) -> LabelmapStateAction:
+        labelmap_name, action = item
+        return env.compute_state(labelmap_name, np.asarray(action), num_threads=num_sitk_threads)
+
+    def compute_reward(state_and_clusters: tuple[LabelmapStateAction, dict]) -> LabelmapPipelineResult:
+        state_action, tissue_clusters = state_and_clusters
+        return LabelmapPipelineResult(
+            state_action=state_action,
+            tissue_clusters=tissue_clusters,
+            reward=reward_fn(state_action, tissue_clusters),
+        )
+
+    return StreamingPipeline([
+        PipelineStage(name="slicing", fn=compute_state, num_workers=num_slicing_workers, queue_size=queue_size),
+        PipelineStage(
+            name="clustering",
+            fn=functools.partial(_cluster, tissues),
+            num_workers=num_clustering_workers,
+            queue_size=queue_size,
+            use_processes=cluster_in_processes,
+        ),
+        PipelineStage(name="reward", fn=compute_reward, num_workers=num_reward_workers, queue_size=queue_size),
+    ])
@@ -32,14 +32,16 @@ def padding(original_array: np.ndarray) -> np.ndarray:
 
     return padded_array
 
-def slice_volume(z_rotation: float, x_rotation: float, translation: np.ndarray, volume: sitk.Image) -> sitk.Image:
+def get_slice_plane(z_rotation: float, x_rotation: float, translation: np.ndarray, origin: np.ndarray,
+                    volume_size: tuple[int, int, int]) -> tuple[np.ndarray, np.ndarray, tuple[int, int]]:
     """
-    Slice a 3D volume with arbitrary rotation and translation
+    Compute the geometry of the image plane used by :func:`slice_volume`
     :param z_rotation: rotation around z-axis in degrees
     :param x_rotation: rotation around x-axis in degrees
     :param translation: translation vector in 3D space
-    :param volume: 3D volume to be sliced
-    :return: the sliced volume
+    :param origin: origin of the volume
+    :param volume_size: size of the volume in voxels (x, y, z)
+    :return: direction of the plane as flattened 3x3 matrix, origin of the plane and size (w, h) of the plane
     """
 
     # Euler transformation
@@ -47,7 +49,7 @@ def slice_volume(z_rotation: float, x_rotation: float, translation: np.ndarray,
     th_z1 = np.deg2rad(z_rotation)
     th_x2 = np.deg2rad(x_rotation)
 
-    o = np.array(volume.GetOrigin())
+    o = np.array(origin)
     t = translation
 
     # transformation simplified at z2=0 since this rotation is never performed
@@ -64,23 +66,92 @@ def slice_volume(z_rotation: float, x_rotation: float, translation: np.ndarray,
 
     direction = np.stack([e1, e2, e3], axis=0).flatten()
 
-    resampler = sitk.ResampleImageFilter()
-    spacing = volume.GetSpacing()
-    volume_size = volume.GetSize()
-
     # Define the size of the output image
     # height of the image plane: original z size divided by cosine of x-rotation
     h = int(abs(volume_size[2]//e3[2]))
     # width of the image plane: original x size divided by cosine of z-rotation
     w = int(abs(volume_size[0]//e1[0]))
 
+    return direction, img_o, (w, h)
+
+
+def slice_volume(z_rotation: float, x_rotation: float, translation: np.ndarray, volume: sitk.Image,
+                 num_threads: int | None = None) -> sitk.Image:
+    """
+    Slice a 3D volume with arbitrary rotation and translation
+    :param z_rotation: rotation around z-axis in degrees
+    :param x_rotation: rotation around x-axis in degrees
+    :param translation: translation vector in 3D space
+    :param volume: 3D volume to be sliced
+    :param num_threads: number of threads used for resampling, defaults to SimpleITK's global default
+    :return: the sliced volume
+    """
+    direction, img_o, (w, h) = get_slice_plane(z_rotation, x_rotation, translation, volume.GetOrigin(),
+                                               volume.GetSize())
+
+    resampler = sitk.ResampleImageFilter()
+    spacing = volume.GetSpacing()
+
     resampler.SetOutputDirection(direction.tolist())
     resampler.SetOutputOrigin(img_o.tolist())
     resampler.SetOutputSpacing(spacing)
     resampler.SetSize((w, 3, h))
     resampler.SetInterpolator(sitk.sitkNearestNeighbor)
+    if num_threads is not None:
+        resampler.SetNumberOfThreads(num_threads)
 
     # Resample the volume on the arbitrary plane
     sliced_volume = resampler.Execute(volume)
 
-    return sliced_volume
\ No newline at end of file
+    return sliced_volume
+
+
+def get_slice_index_affine(z_rotation: float, x_rotation: float, translation: np.ndarray, origin: np.ndarray,
+                           spacing: np.ndarray, direction: np.ndarray, volume_size: tuple[int, int, int]
+                           ) -> tuple[np.ndarray, np.ndarray, np.ndarray, tuple[int, int]]:
+    """
+    Compute the affine map from a pixel (k, i) of the 2D slice (as used by the env, i.e. the zeroth channel
+    of :func:`slice_volume`) to the continuous voxel index (x, y, z) of the volume it is sampled from:
+    base + i * step_i + k * step_k
+    :param z_rotation: rotation around z-axis in degrees
+    :param x_rotation: rotation around x-axis in degrees
+    :param translation: translation vector in 3D space
+    :param origin: origin of the volume
+    :param spacing: spacing of the volume
+    :param direction: direction of the volume as flattened 3x3 matrix
+    :param volume_size: size of the volume in voxels (x, y, z)
+    :return: base, step_i, step_k and the size (w, h) of the slice
+    """
+    plane_direction, img_o, (w, h) = get_slice_plane(z_rotation, x_rotation, translation, origin, volume_size)
+    spacing = np.asarray(spacing, dtype=float)
+    plane_direction = plane_direction.reshape(3, 3)
+
+    # pixel (k, i) has the continuous index (i, 0, k) in the sliced volume -> physical point -> index in the volume
+    to_volume_index = np.linalg.inv(np.asarray(direction, dtype=float).reshape(3, 3) * spacing)
+    base = to_volume_index @ (img_o - np.asarray(origin))
+    step_i = to_volume_index @ (plane_direction[:, 0] * spacing[0])
+    step_k = to_volume_index @ (plane_direction[:, 2] * spacing[2])
+    return base, step_i, step_k, (w, h)
+
+
+def get_slice_voxel_indices(z_rotation: float, x_rotation: float, translation: np.ndarray, origin: np.ndarray,
+                            spacing: np.ndarray, direction: np.ndarray,
+                            volume_size: tuple[int, int, int]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Compute which voxel of the volume each pixel of the 2D slice is sampled from, without resampling the volume
+    :param z_rotation: rotation around z-axis in degrees
+    :param x_rotation: rotation around x-axis in degrees
+    :param translation: translation vector in 3D space
+    :param origin: origin of the volume
+    :param spacing: spacing of the volume
+    :param direction: direction of the volume as flattened 3x3 matrix
+    :param volume_size: size of the volume in voxels (x, y, z)
+    :return: voxel indices (x, y, z) of shape (h, w, 3) and a mask of shape (h, w) of the pixels inside the volume
+    """
+    base, step_i, step_k, (w, h) = get_slice_index_affine(z_rotation, x_rotation, translation, origin, spacing,
+                                                          direction, volume_size)
+    k, i = np.mgrid[:h, :w]
+    volume_indices = np.rint(base + i[..., None] * step_i + k[..., None] * step_k).astype(int)
+
+    is_inside = np.all((volume_indices >= 0) & (volume_indices < np.asarray(volume_size)), axis=-1)
+    return volume_indices, is_inside
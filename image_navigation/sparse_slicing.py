@@ -0,0 +1,128 @@
+from dataclasses import dataclass
+
+import numpy as np
+import SimpleITK as sitk
+
+from image_navigation.slicing import get_slice_index_affine
+
+BBox = tuple[int, int, int, int]
+"""Bounding box (y_start, x_start, y_end, x_end) in pixels, end exclusive."""
+
+
+@dataclass(kw_only=True)
+class SparseSlice:
+    labels_2d_slice: np.ndarray
+    """The slice, identical to the zeroth channel of :func:`image_navigation.slicing.slice_volume`."""
+    label2bbox: dict[int, BBox | None]
+    """For each non-background label, a bounding box containing all its pixels (None if the label is absent).
+    The boxes are conservative, i.e. they may be larger than needed."""
+
+
+class BrickOccupancyIndex:
+    def __init__(self, volume: sitk.Image, brick_size: int = 8, background_label: int = 0):
+        """
+        Index of a labelmap volume divided into cubic bricks of `brick_size` voxels, storing which labels each
+        brick contains. Used for slicing only the parts of a plane that cross non-empty bricks, see :meth:`slice`.
+
+        :param volume: the labelmap volume. The index keeps a reference to it and reads its voxels without copying.
+        :param brick_size: edge length of the bricks in voxels
+        :param background_label: label that is considered empty
+        """
+        if brick_size < 1:
+            raise ValueError(f"brick_size must be positive, got {brick_size}")
+        self.volume = volume
+        self.brick_size = brick_size
+        self.background_label = background_label
+        # array axes are (z, y, x), voxel indices are (x, y, z)
+        self._voxels = sitk.GetArrayViewFromImage(volume)
+        self.labels = tuple(int(label) for label in np.unique(self._voxels) if label != background_label)
+
+        num_bricks = [-(-n // brick_size) for n in self._voxels.shape]
+        padded_shape = [n * brick_size for n in num_bricks]
+        padding = [(0, padded - n) for padded, n in zip(padded_shape, self._voxels.shape)]
+        padded = np.pad(self._voxels, padding, constant_values=background_label)
+        bricks = padded.reshape(num_bricks[0], brick_size, num_bricks[1], brick_size, num_bricks[2], brick_size)
+        self.occupancy = np.stack([(bricks == label).any(axis=(1, 3, 5)) for label in self.labels]) \
+            if self.labels else np.zeros((0, *num_bricks), dtype=bool)
+        """Boolean array of shape (n_labels, n_bricks_z, n_bricks_y, n_bricks_x)"""
+
+        # summed-volume tables for counting occupied bricks in a box in O(1)
+        self._occupancy_sums = np.pad(
+            self.occupancy.astype(np.int32).cumsum(axis=1).cumsum(axis=2).cumsum(axis=3),
+            ((0, 0), (1, 0), (1, 0), (1, 0)),
+        )
+
+    def _count_occupied_bricks(self, brick_start: np.ndarray, brick_end: np.ndarray) -> np.ndarray:
+        """
+        :param brick_start: array of shape (N, 3) with the first brick index (x, y, z) of each box
+        :param brick_end: array of shape (N, 3) with the exclusive last brick index (x, y, z) of each box
+        :return: array of shape (n_labels, N) with the number of bricks containing each label per box
+        """
+        (x0, y0, z0), (x1, y1, z1) = brick_start.T, brick_end.T
+        s = self._occupancy_sums
+        return (
+            s[:, z1, y1, x1] - s[:, z0, y1, x1] - s[:, z1, y0, x1] - s[:, z1, y1, x0]
+            + s[:, z0, y0, x1] + s[:, z0, y1, x0] + s[:, z1, y0, x0] - s[:, z0, y0, x0]
+        )
+
+    def slice(self, z_rotation: float, x_rotation: float, translation: np.ndarray,
+              tile_size: int | None = None) -> SparseSlice:
+        """
+        Slices the volume like :func:`image_navigation.slicing.slice_volume`, but only samples tiles of the
+        plane that cross bricks containing a non-background label. All other pixels are background.
+
+        :param z_rotation: rotation around z-axis in degrees
+        :param x_rotation: rotation around x-axis in degrees
+        :param translation: translation vector in 3D space
+        :param tile_size: edge length of the square tiles of the plane in pixels. Defaults to the brick size.
+        """
+        tile_size = tile_size or self.brick_size
+        volume = self.volume
+        volume_size = np.array(volume.GetSize())
+        base, step_i, step_k, (w, h) = get_slice_index_affine(
+            z_rotation, x_rotation, translation, volume.GetOrigin(), volume.GetSpacing(), volume.GetDirection(),
+            volume.GetSize(),
+        )
+        labels_2d_slice = np.full((h, w), self.background_label, dtype=self._voxels.dtype)
+        if not self.labels or h == 0 or w == 0:
+            return SparseSlice(labels_2d_slice=labels_2d_slice, label2bbox={label: None for label in self.labels})
+
+        # the continuous voxel index is affine in the pixel, so the voxels of a tile are bounded by its corners
+        n_tiles_y, n_tiles_x = -(-h // tile_size), -(-w // tile_size)
+        tile_k0, tile_i0 = np.mgrid[:n_tiles_y, :n_tiles_x] * tile_size
+        tile_k1, tile_i1 = np.minimum(tile_k0 + tile_size, h) - 1, np.minimum(tile_i0 + tile_size, w) - 1
+        corners = np.stack([
+            base + i[..., None] * step_i + k[..., None] * step_k
+            for k, i in [(tile_k0, tile_i0), (tile_k0, tile_i1), (tile_k1, tile_i0), (tile_k1, tile_i1)]
+        ])
+        voxel_start = np.floor(corners.min(axis=0)).astype(int).reshape(-1, 3)
+        voxel_end = np.ceil(corners.max(axis=0)).astype(int).reshape(-1, 3)
+
+        is_inside = np.all((voxel_end >= 0) & (voxel_start < volume_size), axis=-1)
+        brick_start = np.clip(voxel_start, 0, volume_size - 1) // self.brick_size
+        brick_end = np.clip(voxel_end, 0, volume_size - 1) // self.brick_size + 1
+        label_tile_mask = (self._count_occupied_bricks(brick_start, brick_end) > 0) & is_inside
+        label_tile_mask = label_tile_mask.reshape(len(self.labels), n_tiles_y, n_tiles_x)
+
+        # sample only the pixels of occupied tiles
+        tile_mask = label_tile_mask.any(axis=0)
+        pixel_mask = np.repeat(np.repeat(tile_mask, tile_size, axis=0), tile_size, axis=1)[:h, :w]
+        k, i = np.nonzero(pixel_mask)
+        voxel_indices = np.rint(base + i[:, None] * step_i + k[:, None] * step_k).astype(int)
+        is_voxel_inside = np.all((voxel_indices >= 0) & (voxel_indices < volume_size), axis=-1)
+        x, y, z = voxel_indices[is_voxel_inside].T
+        labels_2d_slice[k[is_voxel_inside], i[is_voxel_inside]] = self._voxels[z, y, x]
+
+        label2bbox = {}
+        for label, mask in zip(self.labels, label_tile_mask):
+            rows, cols = np.nonzero(mask.any(axis=1))[0], np.nonzero(mask.any(axis=0))[0]
+            if len(rows) == 0:
+                label2bbox[label] = None
+                continue
+            label2bbox[label] = (
+                int(rows[0] * tile_size),
+                int(cols[0] * tile_size),
+                int(min((rows[-1] + 1) * tile_size, h)),
+                int(min((cols[-1] + 1) * tile_size, w)),
+            )
+        return SparseSlice(labels_2d_slice=labels_2d_slice, label2bbox=label2bbox)
@@ -23,12 +23,22 @@ class Tissues:
         return self.tissues_dict 
 
 
-    def find_clusters(self, tissue_value: int, slice: np.ndarray) -> list[dict]:
+    def find_clusters(self, tissue_value: int, slice: np.ndarray,
+                      bbox: tuple[int, int, int, int] | None = None) -> list[dict]:
         """ Find clusters of a given tissue in a slice
         :param tissue_value: value of the tissue to cluster
         :param slice: image slice to cluster
+        :param bbox: optional bounding box (y_start, x_start, y_end, x_end) containing all pixels of the tissue,
+            e.g. from :class:`image_navigation.sparse_slicing.SparseSlice`. Only this region is scanned.
         :return: list of clusters and their centers
         """
+        # Restrict the work to the region that can contain the tissue
+        offset = np.zeros(2, dtype=int)
+        if bbox is not None:
+            y_start, x_start, y_end, x_end = bbox
+            slice = slice[y_start:y_end, x_start:x_end]
+            offset = np.array([y_start, x_start])
+
         # Create a binary mask based on the threshold
         binary_mask = (slice == tissue_value)
 
@@ -45,6 +55,7 @@ class Tissues:
         
         for cluster_label in range(num_clusters):
             cluster_indices = np.where(labeled_array == cluster_label+1)
+            cluster_indices = (cluster_indices[0] + offset[0], cluster_indices[1] + offset[1])
             # Calculate the center of the cluster
             center_x = np.mean(cluster_indices[0])
             center_y = np.mean(cluster_indices[1])
@@ -57,10 +68,12 @@ class Tissues:
         return cluster_data
     
 
-    def cluster_iter(self, slice: np.ndarray) -> dict:
+    def cluster_iter(self, slice: np.ndarray, label2bbox: dict | None = None) -> dict:
         """ Find clusters of all tissues in a slice
         :param tissues: dictionary of tissues and their values
         :param slice: image slice to cluster
+        :param label2bbox: optional bounding boxes of the tissue values, see :meth:`find_clusters`.
+            A value of None means the tissue is absent from the slice.
         :return: dictionary of tissues and their clusters
         """
         # store clsuters of tissues in a dict
@@ -70,7 +83,11 @@ class Tissues:
 
         for tissue in tissues:
             print(f"Finding {tissue} clusters, with value {tissues[tissue]}:")
-            tissues_clusters[tissue] = (self.find_clusters(tissues[tissue], slice))
+            if label2bbox is not None and tissues[tissue] in label2bbox:
+                bbox = label2bbox[tissues[tissue]]
+                tissues_clusters[tissue] = [] if bbox is None else self.find_clusters(tissues[tissue], slice, bbox)
+            else:
+                tissues_clusters[tissue] = (self.find_clusters(tissues[tissue], slice))
 
             print(f"Found {len(tissues_clusters[tissue])} clusters\n")
         print("---------------------------------------\n")     
@@ -69,3 +69,40 @@ def centered_constrained_bbox(
     new_x_pos = x_pos + (x_size - new_x_size + 1) // 2
 
     return new_y_pos, new_x_pos, new_y_size, new_x_size
+
+
+def pack_label_channels(labels_img: np.ndarray, labels: tuple[int, ...]) -> np.ndarray:
+    """
+    Encodes a label image as one binary channel per label, with the bits of each channel packed along the last axis.
+
+    :param labels_img: integer array of shape (..., H, W)
+    :param labels: the label values that get a channel, in channel order
+    :return: uint8 array of shape (..., len(labels), H, ceil(W / 8))
+    """
+    channels = np.stack([labels_img == label for label in labels], axis=-3)
+    return np.packbits(channels, axis=-1)
+
+
+def unpack_label_channels(packed: np.ndarray, width: int, dtype: np.dtype = np.float32) -> np.ndarray:
+    """
+    Inverse of :func:`pack_label_channels`. Works on arbitrary leading (e.g. batch) dimensions.
+
+    :param packed: uint8 array of shape (..., C, H, ceil(width / 8))
+    :param width: width of the original label image, needed to strip the bit padding
+    :param dtype: dtype of the returned channels
+    :return: array of shape (..., C, H, width) with values in {0, 1}
+    """
+    return np.unpackbits(packed, axis=-1, count=width).astype(dtype, copy=False)
+
+
+def label_image_to_one_hot(labels_img: np.ndarray, labels: tuple[int, ...], dtype: np.dtype = np.float32) -> np.ndarray:
+    """
+    Expands a (batch of) label image(s) into one binary channel per label.
+
+    :param labels_img: integer array of shape (..., H, W)
+    :param labels: the label values that get a channel, in channel order
+    :param dtype: dtype of the returned channels
+    :return: array of shape (..., len(labels), H, W) with values in {0, 1}
+    """
+    labels_arr = np.asarray(labels).reshape(-1, 1, 1)
+    return (labels_img[..., None, :, :] == labels_arr).astype(dtype, copy=False)